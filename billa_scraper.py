@@ -5,47 +5,159 @@ Extracts product names and prices from https://ssbbilla.site/weekly
 """
 
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from bs4 import BeautifulSoup, SoupStrainer
 import json
 import re
 from datetime import datetime
+from dataclasses import dataclass, asdict
 import os
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+try:
+    import requests_cache
+except ImportError:
+    requests_cache = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
+# Patterns used on every product container, compiled once at import time
+_PRICE_RE = re.compile(r'\d+\.\d+\s*(?:лв\.|€)')
+_CENA_RE = re.compile(r'цена\s*-?\s*', re.IGNORECASE)
+_WS_RE = re.compile(r'\s+')
+_DISCOUNT_RE = re.compile(r'-\s*(\d+)%')
+
+# Only the product containers are built into the tree when extracting
+_PRODUCT_STRAINER = SoupStrainer('div', class_='product')
+
+# Upper bound on brochure pages downloaded at the same time
+MAX_FETCH_WORKERS = 8
+
+# Non-product entries (headers, footers, etc.). Literal prefixes are checked
+# with str.startswith; the rest are fused into one alternation so each name
+# is scanned once instead of once per pattern
+_NP_PREFIXES = (
+    'валидност:',
+    'мултипак оферта',
+    'предстояща брошура',
+    'седмична брошура',
+    'обратно на училище',
+)
+_NP_ANCHORED = re.compile(
+    r'^(?:празнувай.*billa'
+    r'|\d+\s*години'
+    r'|над\s*\d+\s*продукта'
+    r'|\*.*виж повече'
+    r'|\*\*.*номерацията)',
+    re.IGNORECASE,
+)
+_NP_UNANCHORED = re.compile(r'www\.billa\.bg', re.IGNORECASE)
+
+@dataclass(slots=True)
+class Product:
+    """A single brochure product; serialized field by field in this order"""
+    name: str
+    old_price: float | None
+    new_price: float | None
+    currency: str = 'лв.'  # Always use lev as specified
+    discount_percent: int | None = None
+    extracted_at: str = ''
 
 class BillaScraper:
-    def __init__(self):
+    def __init__(self, debug=None, force=False, cache=True):
         self.base_url = "https://ssbbilla.site/weekly"
-        self.session = requests.Session()
+        # HTML structure dumps are opt-in: BILLA_DEBUG=1 or --debug
+        if debug is None:
+            debug = os.environ.get('BILLA_DEBUG') == '1'
+        self.debug = debug
+        # Re-extract pages even when the server reports them unchanged
+        self.force = force
+        if cache and requests_cache is not None:
+            # Honours Cache-Control/ETag, so unchanged brochures come back as a
+            # 304 revalidation (or straight from SQLite) instead of a full download
+            self.session = requests_cache.CachedSession(
+                'billa_cache', expire_after=3600, cache_control=True
+            )
+        else:
+            self.session = requests.Session()
         self.session.headers.update({
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
         })
+        # Keep-alive pool sized for concurrent page fetches, retrying transient gateway errors
+        adapter = HTTPAdapter(
+            pool_connections=10,
+            pool_maxsize=MAX_FETCH_WORKERS,
+            max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
     
-    def fetch_page(self):
-        """Fetch the weekly brochure page"""
+    def fetch_page(self, url=None):
+        """Fetch a brochure page (the weekly brochure by default)"""
         try:
-            response = self.session.get(self.base_url)
+            response = self.session.get(url or self.base_url)
             response.raise_for_status()
-            return response.text
+            return response
         except requests.RequestException as e:
             print(f"Error fetching page: {e}")
             return None
     
-    def extract_products(self, html_content):
-        """Extract products from the HTML content"""
-        soup = BeautifulSoup(html_content, 'html.parser')
+    def fetch_pages(self, urls):
+        """Fetch several brochure pages concurrently, yielding their responses in order"""
+        workers = max(1, min(MAX_FETCH_WORKERS, len(urls)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # map() yields each page as soon as it and the ones before it are in,
+            # so parsing overlaps with the downloads still in flight
+            yield from executor.map(self.fetch_page, urls)
+    
+    def parse_html(self, html_content):
+        """Parse a page; the whole document is only built when debugging needs it"""
+        parse_only = None if self.debug else _PRODUCT_STRAINER
+        return BeautifulSoup(html_content, HTML_PARSER, parse_only=parse_only)
+    
+    def extract_page(self, html_content):
+        """Parse a page once and extract its products"""
+        soup = self.parse_html(html_content)
+        if self.debug:
+            self.debug_html_structure(soup, html_content)
+        return self.extract_products(soup)
+    
+    def extract_products(self, soup):
+        """Extract products from the parsed page"""
         products = []
+        # All products of one page share the same extraction time
+        extracted_at = datetime.now().isoformat()
         
         # Look for product containers with class "product"
         product_containers = soup.find_all('div', class_='product')
         
         for container in product_containers:
             try:
+                parts = self.select_product_parts(container)
+                
                 # Find the actualProduct div
-                product_div = container.find('div', class_='actualProduct')
+                product_div = parts.get('name')
                 if not product_div:
                     continue
                 
-                # Extract product name
-                product_name = self.clean_product_name(product_div.get_text(strip=True))
+                # Extract product name; it is normally the div's only text node,
+                # so only fall back to a full get_text() walk for nested markup
+                name_text = product_div.string
+                if name_text is None:
+                    name_text = product_div.get_text(strip=True)
+                product_name = self.clean_product_name(name_text)
                 
                 if not product_name or len(product_name.strip()) < 3:
                     continue
@@ -55,17 +167,16 @@ class BillaScraper:
                     continue
                 
                 # Extract prices from the container
-                prices = self.extract_prices_from_container(container)
+                prices = self.extract_prices(parts)
                 
                 if prices['old_price'] is not None or prices['new_price'] is not None:
-                    products.append({
-                        'name': product_name,
-                        'old_price': prices['old_price'],
-                        'new_price': prices['new_price'],
-                        'currency': 'лв.',  # Always use lev as specified
-                        'discount_percent': prices.get('discount'),
-                        'extracted_at': datetime.now().isoformat()
-                    })
+                    products.append(Product(
+                        name=product_name,
+                        old_price=prices['old_price'],
+                        new_price=prices['new_price'],
+                        discount_percent=prices.get('discount'),
+                        extracted_at=extracted_at,
+                    ))
                     
             except Exception as e:
                 print(f"Error processing product: {e}")
@@ -76,69 +187,101 @@ class BillaScraper:
     def clean_product_name(self, text):
         """Clean and extract product name from text"""
         # Remove price information and extra spaces
-        cleaned = re.sub(r'\d+\.\d+\s*(лв\.|€)', '', text)
-        cleaned = re.sub(r'цена\s*-?\s*', '', cleaned, flags=re.IGNORECASE)
-        cleaned = re.sub(r'\s+', ' ', cleaned).strip()
+        cleaned = _PRICE_RE.sub('', text)
+        cleaned = _CENA_RE.sub('', cleaned)
+        cleaned = _WS_RE.sub(' ', cleaned).strip()
         return cleaned if len(cleaned) > 3 else None
     
     def is_non_product(self, text):
         """Check if text represents a non-product entry"""
-        non_product_patterns = [
-            r'^празнувай.*billa',
-            r'^\d+\s*години',
-            r'^валидност:',
-            r'^над\s*\d+\s*продукта',
-            r'^\*.*виж повече',
-            r'^\*\*.*номерацията',
-            r'^мултипак оферта',
-            r'www\.billa\.bg',
-            r'^предстояща брошура',
-            r'^седмична брошура',
-            r'^обратно на училище'
-        ]
-        
         text_lower = text.lower()
-        for pattern in non_product_patterns:
-            if re.search(pattern, text_lower, re.IGNORECASE):
-                return True
-        return False
+        if text_lower.startswith(_NP_PREFIXES):
+            return True
+        return bool(_NP_ANCHORED.match(text_lower) or _NP_UNANCHORED.search(text_lower))
+    
+    def select_product_parts(self, container):
+        """Collect the name, discount and price nodes of a product container in one pass"""
+        parts = {'old_prices': [], 'new_prices': []}
+        # Iterating descendants directly skips find_all's per-call matching machinery
+        for node in container.descendants:
+            if node.name not in ('div', 'span'):
+                continue
+            classes = node.get('class') or []
+            if node.name == 'span':
+                # Price spans come after their section div in document order,
+                # so the section they belong to is already known here
+                if 'price' in classes:
+                    for ancestor in node.parents:
+                        if ancestor is container:
+                            break
+                        if ancestor is parts.get('old_price'):
+                            parts['old_prices'].append(node)
+                            break
+                        if ancestor is parts.get('new_price'):
+                            parts['new_prices'].append(node)
+                            break
+                continue
+            
+            style = node.get('style') or ''
+            # Keep the first match of each kind, like container.find() would
+            if 'actualProduct' in classes:
+                parts.setdefault('name', node)
+            if 'discount' in classes:
+                parts.setdefault('discount', node)
+            if 'width:21%' in style:
+                parts.setdefault('old_price', node)
+            if 'width:15%' in style:
+                parts.setdefault('new_price', node)
+        return parts
     
-    def extract_prices_from_container(self, container):
-        """Extract old and new prices from the product container"""
+    def parse_price(self, span):
+        """Read the numeric value of a price span"""
+        # Price spans hold a single text node and float() ignores surrounding
+        # whitespace, so .string spares the get_text() walk
+        text = span.string
+        if text is None:
+            text = span.get_text(strip=True)
+        return float(text)
+    
+    def extract_prices(self, parts):
+        """Extract old and new prices from the parts of a product container"""
         prices = {'old_price': None, 'new_price': None, 'discount': None}
         
         # Look for discount percentage
-        discount_div = container.find('div', class_='discount')
+        discount_div = parts.get('discount')
         if discount_div:
             discount_text = discount_div.get_text(strip=True)
-            discount_match = re.search(r'-\s*(\d+)%', discount_text)
+            discount_match = _DISCOUNT_RE.search(discount_text)
             if discount_match:
                 prices['discount'] = int(discount_match.group(1))
         
-        # Find the old price section (width:21%)
-        old_price_div = container.find('div', style=re.compile(r'width:21%'))
-        if old_price_div:
-            old_price_spans = old_price_div.find_all('span', class_='price')
-            if len(old_price_spans) >= 1:
-                # First price in old section is the actual old price in BGN
-                prices['old_price'] = float(old_price_spans[0].get_text(strip=True))
-                
-                # Second price in old section is actually the new price in BGN (mislabeled as EUR)
-                if len(old_price_spans) >= 2:
-                    prices['new_price'] = float(old_price_spans[1].get_text(strip=True))
+        # Prices in the old price section (width:21%)
+        old_price_spans = parts['old_prices']
+        if len(old_price_spans) >= 1:
+            # First price in old section is the actual old price in BGN
+            prices['old_price'] = self.parse_price(old_price_spans[0])
+            
+            # Second price in old section is actually the new price in BGN (mislabeled as EUR)
+            if len(old_price_spans) >= 2:
+                prices['new_price'] = self.parse_price(old_price_spans[1])
         
         # If we didn't find new price in old section, look in new price section (width:15%)
         if prices['new_price'] is None:
-            new_price_div = container.find('div', style=re.compile(r'width:15%'))
-            if new_price_div:
-                new_price_spans = new_price_div.find_all('span', class_='price')
-                if len(new_price_spans) >= 1:
-                    # First price in new section might be the new price
-                    prices['new_price'] = float(new_price_spans[0].get_text(strip=True))
+            new_price_spans = parts['new_prices']
+            if len(new_price_spans) >= 1:
+                # First price in new section might be the new price
+                prices['new_price'] = self.parse_price(new_price_spans[0])
         
         return prices
     
     
+    def encode_product(self, product):
+        """Serialize one product as indented UTF-8 JSON"""
+        if orjson is not None:
+            # orjson serializes dataclasses natively, without an intermediate dict
+            return orjson.dumps(product, option=orjson.OPT_INDENT_2)
+        return json.dumps(asdict(product), ensure_ascii=False, indent=2).encode('utf-8')
+    
     def save_to_json(self, products, filename=None):
         """Save products to JSON file"""
         if filename is None:
@@ -148,15 +291,34 @@ class BillaScraper:
         # Ensure output directory exists
         os.makedirs('output', exist_ok=True)
         
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(products, f, ensure_ascii=False, indent=2)
+        # Write to a hidden sibling and rename it into place, so a crash never
+        # leaves a truncated billa_brochure_*.json for the importer to pick up
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(filename) or '.', prefix='.billa_', suffix='.json'
+        )
+        try:
+            # Write the array one product at a time so the whole document is never
+            # held in memory; products may be any iterable, including a generator
+            with os.fdopen(fd, 'wb') as f:
+                f.write(b'[')
+                empty = True
+                for product in products:
+                    f.write(b'\n  ' if empty else b',\n  ')
+                    # Nest each object's indent=2 layout one level inside the array
+                    f.write(self.encode_product(product).replace(b'\n', b'\n  '))
+                    empty = False
+                f.write(b']' if empty else b'\n]')
+            # mkstemp creates the file owner-only; keep the usual output permissions
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, filename)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
         
         return filename
     
-    def debug_html_structure(self, html_content):
+    def debug_html_structure(self, soup, html_content):
         """Debug method to inspect HTML structure"""
-        soup = BeautifulSoup(html_content, 'html.parser')
-        
         # Save raw HTML for inspection
         with open('debug_html.html', 'w', encoding='utf-8') as f:
             f.write(html_content)
@@ -187,7 +349,7 @@ class BillaScraper:
                 print(f"Total divs found: {len(all_divs)}")
                 
                 # Look for divs with style attributes
-                styled_divs = [div for div in all_divs if div.get('style')]
+                styled_divs = soup.find_all('div', style=True)
                 print(f"Divs with style attributes: {len(styled_divs)}")
                 
                 if styled_divs:
@@ -199,20 +361,39 @@ class BillaScraper:
         
         print("=" * 50)
 
-    def scrape(self):
+    def fetched_pages(self, urls):
+        """Yield the HTML of every page that was fetched and needs extracting"""
+        for url, response in zip(urls, self.fetch_pages(urls)):
+            if response is None:
+                print(f"Failed to fetch page content from {url}")
+                continue
+            
+            if getattr(response, 'from_cache', False) and not self.force:
+                print(f"Page unchanged since the last run, skipping {url} (use --force to re-extract)")
+                continue
+            
+            print("Extracting products...")
+            yield response.text
+
+    def scrape(self, urls=None):
         """Main scraping method"""
+        urls = urls or [self.base_url]
         print("Fetching Billa weekly brochure...")
-        html_content = self.fetch_page()
+        pages = self.fetched_pages(urls)
         
-        if not html_content:
-            print("Failed to fetch page content")
-            return []
+        if len(urls) > 1 and not self.debug:
+            # Parsing is CPU-bound, so spread pages over processes; map() submits
+            # each page as soon as it is downloaded
+            workers = min(len(urls), os.cpu_count() or 1)
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+                page_products = list(executor.map(_extract_page, pages))
+        else:
+            page_products = [self.extract_page(html_content) for html_content in pages]
         
-        # Debug HTML structure first
-        self.debug_html_structure(html_content)
+        if not page_products:
+            return []
         
-        print("Extracting products...")
-        products = self.extract_products(html_content)
+        products = [product for page in page_products for product in page]
         
         if products:
             filename = self.save_to_json(products)
@@ -222,25 +403,42 @@ class BillaScraper:
         
         return products
 
+_worker_scraper = None
+
+def _init_worker():
+    global _worker_scraper
+    _worker_scraper = BillaScraper(debug=False, cache=False)
+
+def _extract_page(html_content):
+    """Process pool entry point: extract the products of one page"""
+    return _worker_scraper.extract_page(html_content)
+
 def main():
-    scraper = BillaScraper()
+    parser = argparse.ArgumentParser(description="Scrape the Billa weekly brochure")
+    parser.add_argument('--debug', action='store_true', default=None,
+                        help="dump the raw HTML and its structure (same as BILLA_DEBUG=1)")
+    parser.add_argument('--force', action='store_true',
+                        help="extract products even if the brochure is unchanged since the last run")
+    args = parser.parse_args()
+    
+    scraper = BillaScraper(debug=args.debug, force=args.force)
     products = scraper.scrape()
     
     if products:
         print("\nSample products:")
         # Show products that have both old and new prices
-        samples = [p for p in products if p.get('old_price') and p.get('new_price')][:5]
+        samples = [p for p in products if p.old_price and p.new_price][:5]
         if not samples:
             samples = products[:5]  # Fallback to first 5
             
         for product in samples:
-            print(f"- {product['name']}")
-            if product.get('old_price'):
-                print(f"  Old price: {product['old_price']} {product['currency']}")
-            if product.get('new_price'):
-                print(f"  New price: {product['new_price']} {product['currency']}")
-            if product.get('discount_percent'):
-                print(f"  Discount: -{product['discount_percent']}%")
+            print(f"- {product.name}")
+            if product.old_price:
+                print(f"  Old price: {product.old_price} {product.currency}")
+            if product.new_price:
+                print(f"  New price: {product.new_price} {product.currency}")
+            if product.discount_percent:
+                print(f"  Discount: -{product.discount_percent}%")
             print()
 
 if __name__ == "__main__":